@@ -1,7 +1,12 @@
 import streamlit as st
 import pandas as pd
 import requests
+import shutil
+import textwrap
+from requests.adapters import HTTPAdapter
+from streamlit.errors import StreamlitAPIException
 from io import BytesIO
+from pathlib import Path
 import plotly.express as px
 
 # Configuration de la page
@@ -11,132 +16,221 @@ st.set_page_config(
     layout="wide"
 )
 
+# Cache disque de l'arbre préparé, invalidé par l'ETag Nextcloud ou un changement de format
+TREE_CACHE = Path(__file__).parent / "tree.parquet"
+ETAG_CACHE = Path(__file__).parent / "criteres.etag"
+CACHE_VERSION = 1       # À incrémenter quand prepare_tree_data change de sortie
+
+# Variables de configuration - modifiables manuellement
+EXPOSCORE_SIZE = 40     # Taille du texte pour Exposcore (titre principal)
+IMPACT_SIZE =  26       # Taille du texte pour les sous-titres d'impacts
+TYPE_SIZE = 22          # Taille du texte pour les types
+CRITERE_SIZE = 18       # Taille du texte pour les critères
+DESCRIPTION_SIZE = 26   # Taille du texte des descriptions au survol
+CHART_HEIGHT = 600      # Hauteur de chaque graphique
+MAX_CHARS_PER_LINE = 20 # Caractères max par ligne pour les critères
+TREEMAP_CACHE_ENTRIES = 64 # Nombre max de figures gardées en cache
+
+# Découpeur réutilisé pour tous les critères (regex compilée une seule fois)
+_WRAPPER = textwrap.TextWrapper(width=MAX_CHARS_PER_LINE, break_long_words=False, break_on_hyphens=False, drop_whitespace=True)
+
+# Session HTTP partagée pour réutiliser la connexion TLS vers Nextcloud
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=2))
+
+def read_workbook(file_content):
+    """Lit les 4 premières colonnes de la première feuille du classeur"""
+
+    try:
+        return pd.read_excel(file_content, engine='calamine', sheet_name=0, usecols=range(4), dtype_backend='pyarrow')
+    except ImportError:
+        # python-calamine absent : lecture en streaming avec openpyxl
+        from openpyxl import load_workbook
+
+        file_content.seek(0)
+        wb = load_workbook(file_content, read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(max_col=4, values_only=True)
+            header = next(rows)
+            df = pd.DataFrame(rows, columns=[str(h).strip() for h in header]).convert_dtypes(dtype_backend='pyarrow')
+        finally:
+            wb.close()
+        return df
+
+def cache_key(etag):
+    """Clé du cache disque : format de l'arbre, découpage des libellés et ETag distant"""
+
+    return f"{CACHE_VERSION}|{MAX_CHARS_PER_LINE}|{etag}"
+
+def load_cached_data(etag):
+    """Relit l'arbre préparé en local si l'ETag du fichier distant n'a pas changé"""
+
+    if not etag or not TREE_CACHE.exists() or not ETAG_CACHE.exists():
+        return None
+    try:
+        if ETAG_CACHE.read_text(encoding="utf-8") != cache_key(etag):
+            return None
+        df = pd.read_parquet(TREE_CACHE)
+    except (OSError, ValueError, ImportError):
+        return None
+
+    # Selon la version de pandas, le parquet restitue string[python] : on repasse en Arrow
+    string_columns = ['critere', 'description', 'path', 'hover_info', 'critere_formatted']
+    return df.astype({col: 'string[pyarrow]' for col in string_columns})
+
+def save_cached_data(df, etag):
+    """Écrit l'arbre préparé en parquet local avec l'ETag associé"""
+
+    if not etag:
+        return
+    try:
+        df.to_parquet(TREE_CACHE, compression='zstd')
+        ETAG_CACHE.write_text(cache_key(etag), encoding="utf-8")
+    except (OSError, ValueError, TypeError, ImportError):
+        # Le cache disque est facultatif : on ignore les échecs d'écriture
+        ETAG_CACHE.unlink(missing_ok=True)
+
+def fetch_etag(file_url, auth):
+    """Récupère l'ETag (ou Last-Modified) du fichier distant, None en cas d'échec"""
+
+    try:
+        head = _SESSION.head(file_url, auth=auth, timeout=10)
+    except requests.RequestException:
+        return None
+    if not head.ok:
+        return None
+    return head.headers.get('ETag') or head.headers.get('Last-Modified')
+
+def tag_data_version(df, etag):
+    """Mémorise dans df.attrs une clé de version servant de clé de cache bon marché"""
+
+    df.attrs['etag'] = etag or str(pd.util.hash_pandas_object(df, index=False).sum())
+    return df
+
 @st.cache_data(ttl=300)
 def load_criteria_data():
-    """Charge les données depuis Nextcloud"""
+    """Charge depuis Nextcloud les données préparées pour le treemap"""
 
     try:
         username = st.secrets['NEXTCLOUD_USER']
         password = st.secrets['NEXTCLOUD_PASSWORD']
-    except:
+    except (KeyError, FileNotFoundError, StreamlitAPIException):
         st.error("⚠️ Identifiants Nextcloud manquants")
         return None
 
     file_url = f"https://nuage.relief-aura.fr/remote.php/dav/files/{username}/Déjà-Vu/03%20-%20Activités/32%20-%20Le%20Conseil/322%20-%20Exposcore/criteres_eco_eval_db.xlsx"
 
+    auth = (username, password)
+
     try:
-        response = requests.get(file_url, auth=(username, password), timeout=10)
-        if response.status_code == 200:
-            file_content = BytesIO(response.content)
-            df = pd.read_excel(file_content, engine='openpyxl')
-            df.columns = df.columns.str.strip()
-            return df
+        etag = fetch_etag(file_url, auth)
+        df = load_cached_data(etag)
+        if df is not None:
+            return tag_data_version(df, etag and cache_key(etag))
+
+        with _SESSION.get(file_url, auth=auth, timeout=10, stream=True) as response:
+            if response.status_code != 200:
+                return None
+            response.raw.decode_content = True
+            file_content = BytesIO()
+            shutil.copyfileobj(response.raw, file_content, length=1 << 16)
+            file_content.seek(0)
+            etag = response.headers.get('ETag') or response.headers.get('Last-Modified') or etag
+
+        df = read_workbook(file_content)
+        df.columns = df.columns.str.strip()
+        df_tree = prepare_tree_data(df)
+        save_cached_data(df_tree, etag)
+        return tag_data_version(df_tree, etag and cache_key(etag))
     except Exception as e:
         st.error(f"Erreur : {e}")
         return None
 
+def format_text_multiline(text):
+    """Coupe le texte d'un critère sur plusieurs lignes HTML"""
+
+    return "<br>".join(_WRAPPER.wrap(text))
+
 def prepare_tree_data(df):
     """Prépare les données pour le treemap"""
 
     # Nettoyer les données
-    df_clean = df.dropna(subset=[df.columns[0], df.columns[1], df.columns[2]])
+    sub = df.dropna(subset=list(df.columns[:3])).iloc[:, :4].copy()
+    sub.columns = ['impact', 'type', 'critere', 'description']
 
-    # Créer le dataframe pour le treemap
-    tree_data = []
+    for col in ['impact', 'type', 'critere']:
+        sub[col] = sub[col].astype('string[pyarrow]').str.strip()
+    sub['description'] = sub['description'].astype('string[pyarrow]').fillna("").str.strip()
 
-    for _, row in df_clean.iterrows():
-        impact = str(row.iloc[0]).strip()
-        type_name = str(row.iloc[1]).strip()
-        critere = str(row.iloc[2]).strip()
-        description = str(row.iloc[3]).strip() if pd.notna(row.iloc[3]) else ""
+    # Colonnes dérivées pour le treemap
+    sub['path'] = "Exposcore / " + sub['impact'] + " / " + sub['type'] + " / " + sub['critere']
+    sub['hover_info'] = "<b>" + sub['critere'] + "</b><br>" + sub['description']
+    sub['critere_formatted'] = sub['critere'].map(format_text_multiline).astype('string[pyarrow]')
 
-        tree_data.append({
-            'impact': impact,
-            'type': type_name,
-            'critere': critere,
-            'description': description,
-            'path': f"Exposcore / {impact} / {type_name} / {critere}",
-            'hover_info': f"<b>{critere}</b><br>{description}"
-        })
+    # Peu de valeurs distinctes : le type catégoriel allège la mémoire et le groupby
+    sub['impact'] = sub['impact'].astype('category')
+    sub['type'] = sub['type'].astype('category')
 
-    return pd.DataFrame(tree_data)
+    return sub.reset_index(drop=True)
 
-def create_treemap_by_impact(df_tree):
-    """Crée un treemap séparé pour chaque impact"""
+@st.cache_data(show_spinner=False, max_entries=TREEMAP_CACHE_ENTRIES)
+def build_treemap(impact, etag, _impact_data, critere_size, description_size, type_size, chart_height):
+    """Construit le treemap d'un impact
 
-    # Variables de configuration - modifiables manuellement
-    EXPOSCORE_SIZE = 40     # Taille du texte pour Exposcore (titre principal)
-    IMPACT_SIZE =  26       # Taille du texte pour les sous-titres d'impacts
-    TYPE_SIZE = 22          # Taille du texte pour les types
-    CRITERE_SIZE = 18       # Taille du texte pour les critères
-    DESCRIPTION_SIZE = 26   # Taille du texte des descriptions au survol
-    CHART_HEIGHT = 600      # Hauteur de chaque graphique
-    MAX_CHARS_PER_LINE = 20 # Caractères max par ligne pour les critères
+    Le cache est indexé par (impact, etag, tailles) : _impact_data n'est pas haché par Streamlit.
+    """
 
-    impacts = df_tree['impact'].unique()
+    impact_data = _impact_data[['type', 'critere_formatted', 'description']].astype(str)
+
+    fig = px.treemap(
+        impact_data,
+        path=['type', 'critere_formatted'],
+        hover_data={'description': True},
+        title=None
+    )
+
+    fig.update_traces(
+        textinfo="label",
+        hovertemplate=f'<span style="font-size:{description_size}px">%{{customdata[0]}}</span><extra></extra>',
+        textfont_size=critere_size,
+        textfont_color="black",
+        textposition="middle center"
+    )
+
+    # Mise en forme avec tailles différenciées
+    fig.update_layout(
+        height=chart_height,
+        margin=dict(t=10, b=10, l=10, r=10),
+        font=dict(size=type_size)
+    )
+
+    return fig
+
+def create_treemap_by_impact(df_tree):
+    """Crée un treemap séparé pour chaque impact"""
 
     # Titre principal Exposcore
     st.markdown(f"<h1 style='font-size:{EXPOSCORE_SIZE}px; text-align:center'>🌳 Exposcore</h1>", unsafe_allow_html=True)
 
-    for impact in impacts:
+    if 'etag' not in df_tree.attrs:
+        tag_data_version(df_tree, None)
+    etag = df_tree.attrs['etag']
+
+    # Construction séquentielle : px.treemap est du Python pur qui garde le GIL,
+    # un pool de threads n'apporte rien (mesuré) et les reruns passent par le cache
+    for impact, impact_data in df_tree.groupby('impact', sort=False, observed=True):
         # Titre de l'impact avec taille personnalisée
         st.markdown(f"<h2 style='font-size:{IMPACT_SIZE}px'> {impact}</h2>", unsafe_allow_html=True)
 
-        # Filtrer les données pour cet impact
-        impact_data = df_tree[df_tree['impact'] == impact].copy()
-
-        # Formatter le texte des critères sur plusieurs lignes
-        def format_text_multiline(text, max_chars=MAX_CHARS_PER_LINE):
-            words = text.split()
-            lines = []
-            current_line = ""
-
-            for word in words:
-                if len(current_line + " " + word) <= max_chars:
-                    current_line = current_line + " " + word if current_line else word
-                else:
-                    if current_line:
-                        lines.append(current_line)
-                    current_line = word
-
-            if current_line:
-                lines.append(current_line)
-
-            return "<br>".join(lines)
-
-        # Appliquer le formatage multiligne aux critères
-        impact_data['critere_formatted'] = impact_data['critere'].apply(format_text_multiline)
-
-        fig = px.treemap(
-            impact_data,
-            path=['type', 'critere_formatted'],
-            hover_data={'description': True},
-            title=None
-        )
-
-        fig.update_traces(
-            textinfo="label",
-            hovertemplate=f'<span style="font-size:{DESCRIPTION_SIZE}px">%{{customdata[0]}}</span><extra></extra>',
-            textfont_size=CRITERE_SIZE,
-            textfont_color="black",
-            textposition="middle center"
-        )
-
-        # Mise en forme avec tailles différenciées
-        fig.update_layout(
-            height=CHART_HEIGHT,
-            margin=dict(t=10, b=10, l=10, r=10),
-            font=dict(size=TYPE_SIZE)
-        )
+        fig = build_treemap(impact, etag, impact_data, CRITERE_SIZE, DESCRIPTION_SIZE, TYPE_SIZE, CHART_HEIGHT)
 
         st.plotly_chart(fig, use_container_width=True)
         st.markdown("---")
 
 def main():
-    df = load_criteria_data()
+    df_tree = load_criteria_data()
 
-    if df is not None:
-        df_tree = prepare_tree_data(df)
+    if df_tree is not None:
         create_treemap_by_impact(df_tree)
     else:
         st.error("❌ Impossible de charger les données")